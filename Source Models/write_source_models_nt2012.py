@@ -33,6 +33,7 @@ import argparse
 
 from io import StringIO
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -40,21 +41,17 @@ import geopandas as gpd
 
 import matplotlib.pyplot as plt
 from shapely.wkt import dumps
-from shapely.geometry import Point
 from descartes import PolygonPatch
 
-from obspy.imaging.beachball import aux_plane
-
 from more_itertools import unique_everseen
 
 from source_model_tools import (
-    read_polygons, focal_mech, faulting_style, df2nrml, areal2csv,
-    SEISMICITY_ALIASES, points2csv, points2nrml, MyPolygon)
+    read_polygons, focal_mech, faulting_style, aux_planes, df2nrml,
+    areal2csv, SEISMICITY_ALIASES, points2csv, points2nrml, MyPolygon,
+    nearest_polygons)
 from logic_tree_tools import read_tree_tsv, collapse_sources
 from toolbox import wrap
 
-from openquake.hazardlib import geo
-
 pd.set_option('mode.chained_assignment', 'raise')
 
 # define the input file names from the original paper
@@ -78,6 +75,48 @@ SOURCE_TREE_FORMAT = '../Logic Trees/areal_model_logic_tree_v%d.tsv'
 AREAL_MODEL_FORMAT = '%s areal source model v%d'
 SMOOTHED_MODEL_FORMAT = '%s smoothed source model v%d'
 
+# zone polygons, with their projections, reused across calls in one session
+_POLYGON_CACHE = {}
+
+
+def _cached_polygon(zone):
+    '''
+    Return a :class:`MyPolygon` for a shapely polygon, built once per
+    distinct geometry.
+    '''
+    key = zone.wkb
+    if key not in _POLYGON_CACHE:
+        _POLYGON_CACHE[key] = MyPolygon.from_shapely(zone)
+    return _POLYGON_CACHE[key]
+
+
+def _read_smoothed(smoothed_file, layer_id, layer, min_mag, use_recomputed):
+    '''
+    Read smoothed seismicity for one layer and minimum magnitude.
+    '''
+    layer_smoothed_df = pd.read_csv(smoothed_file)
+
+    nu_mag = 'nu%s' % str(min_mag).replace('.', '_')
+
+    rename_cols = {nu_mag: 'nu', 'lat': 'latitude', 'lon': 'longitude'}
+    layer_smoothed_df.rename(columns=rename_cols, inplace=True)
+
+    layer_smoothed_df['layerid'] = layer_id
+    layer_smoothed_df['mmin model'] = min_mag
+    layer_smoothed_df['mmin'] = min_mag
+    layer_smoothed_df['duration'] = (
+        layer[str(min_mag) + ' end'] -
+        layer[str(min_mag) + ' start'] + 1)
+    if use_recomputed:
+        layer_smoothed_df['lambda'] = layer_smoothed_df['nu']
+        layer_smoothed_df['nu'] = (layer_smoothed_df['lambda'] *
+                                   layer_smoothed_df['duration'])
+    else:
+        layer_smoothed_df['lambda'] = (layer_smoothed_df['nu'] /
+                                       layer_smoothed_df['duration'])
+
+    return layer_smoothed_df
+
 
 def write_source_models(version=0, full=False, use_recomputed=False,
                         prefix='nt2012'):
@@ -115,17 +154,15 @@ def write_source_models(version=0, full=False, use_recomputed=False,
         # preserve errors in electonic supplement in version v0
         if int(version) == 0:
             if layer_id == 4:
-                (seismicity_df.loc[169],
-                 seismicity_df.loc[170]) = \
-                    (seismicity_df.loc[170].copy(),
-                     seismicity_df.loc[169].copy())
+                seismicity_df.loc[[169, 170]] = \
+                    seismicity_df.loc[[170, 169]].rename(
+                        index={170: 169, 169: 170})
                 print('Swapped seismicity parameters for zones 169 and 170.')
 
-            for zoneid, row in df_erroneous[df_erroneous.layerid ==
-                                            layer_id].iterrows():
-                row = row.drop('layerid')
-                for column in row.keys():
-                    seismicity_df.loc[zoneid, column] = row[column]
+            layer_erroneous_df = df_erroneous[
+                df_erroneous.layerid == layer_id].drop(columns='layerid')
+            seismicity_df.update(layer_erroneous_df)
+            for zoneid, row in layer_erroneous_df.iterrows():
                 print(
                     'Restored zone %d erroneous %s: %s' %
                     (zoneid, row.keys().values, row.values))
@@ -168,10 +205,9 @@ def write_source_models(version=0, full=False, use_recomputed=False,
     areal_df['mechanism'] = focal_mech(areal_df['dip'], areal_df['rake'])
     areal_df['new style'] = faulting_style(areal_df['strike'], areal_df['dip'],
                                            areal_df['rake'])
-    areal_df['strike2'], areal_df['dip2'], areal_df['rake2'] = zip(*[
-        aux_plane(strike, dip, rake)
-        for strike, dip, rake in zip(
-            areal_df['strike'], areal_df['dip'], areal_df['rake'])])
+    areal_df['strike2'], areal_df['dip2'], areal_df['rake2'] = aux_planes(
+        areal_df['strike'].values, areal_df['dip'].values,
+        areal_df['rake'].values)
     areal_df['mechanism2'] = focal_mech(areal_df['dip2'], areal_df['rake2'])
 
     areal_df['mmin'] = MIN_MAGS[0]
@@ -192,14 +228,17 @@ def write_source_models(version=0, full=False, use_recomputed=False,
     # grab mmax and bvalue from zone above if mmax zero for this zone
     check_keys = ['mmax', 'b']
     none_found = True
-    for i, area_series in areal_df[
-            (areal_df[check_keys] == 0).any(axis=1)].iterrows():
-        alternate_zone = int(area_series.name/10)
-        for key in check_keys:
-            if area_series['a'] != 0 and area_series[key] == 0:
+    missing = ((areal_df['a'].values != 0).reshape(-1, 1) &
+               (areal_df[check_keys].values == 0))
+    any_missing = missing.any(axis=1)
+    for zone, zone_missing in zip(areal_df.index[any_missing],
+                                  missing[any_missing]):
+        alternate_zone = zone//10
+        for key, key_missing in zip(check_keys, zone_missing):
+            if key_missing:
                 print('For zone %d taking %s from zone %d' %
-                      (area_series.name, key, alternate_zone))
-                areal_df.at[i, key] = areal_df.at[alternate_zone, key]
+                      (zone, key, alternate_zone))
+                areal_df.at[zone, key] = areal_df.at[alternate_zone, key]
                 none_found = False
     if none_found:
         print('SUCCESS: All zones already have mmax & b defined.')
@@ -239,55 +278,30 @@ def write_source_models(version=0, full=False, use_recomputed=False,
     completeness_df = pd.read_csv(
         '../Data/thingbaijam2011seismogenic/Table1.csv',
         header=[0, 1], index_col=[0, 1])
-    completeness_df.columns = [' '.join(col).strip()
-                               for col in completeness_df.columns.values]
+    completeness_df.columns = completeness_df.columns.map(' '.join).str.strip()
 
     # electronic supplement for smoothed-gridded model
     print('Reading smoothed seismicity data ...')
     smoothed_data_format = os.path.join(smoothed_data_path, SMOOTHED_FORMAT)
 
     mark = time()
-    smoothed_df_list = []
-    for i, min_mag in enumerate(MIN_MAGS):
-        layer_smoothed_df_list = []
-        for layer_id, layer in layers_df.join(completeness_df,
-                                              on=['zmin', 'zmax']).iterrows():
-
-            layer_smoothed_df = pd.read_csv(smoothed_data_format %
-                                            (layer_id, min_mag))
-            nu_mag = 'nu%s' % str(min_mag).replace('.', '_')
-
-            rename_cols = {nu_mag: 'nu', 'lat': 'latitude', 'lon': 'longitude'}
-            layer_smoothed_df.rename(columns=rename_cols, inplace=True)
-
-            layer_smoothed_df['layerid'] = layer_id
-            layer_smoothed_df['mmin model'] = min_mag
-            layer_smoothed_df['mmin'] = min_mag
-            layer_smoothed_df['duration'] = (
-                layer[str(min_mag) + ' end'] -
-                layer[str(min_mag) + ' start'] + 1)
-            if use_recomputed:
-                layer_smoothed_df['lambda'] = layer_smoothed_df['nu']
-                layer_smoothed_df['nu'] = (layer_smoothed_df['lambda'] *
-                                           layer_smoothed_df['duration'])
-            else:
-                layer_smoothed_df['lambda'] = (layer_smoothed_df['nu'] /
-                                               layer_smoothed_df['duration'])
-
-            layer_smoothed_df_list.append(layer_smoothed_df)
-
-        layer_smoothed_df = pd.concat(layer_smoothed_df_list,
-                                      ignore_index=True)
-        smoothed_df_list.append(layer_smoothed_df)
+    layers_completeness_df = layers_df.join(completeness_df,
+                                            on=['zmin', 'zmax'])
+    # files are independent, so overlap reading and parsing all of them
+    smoothed_jobs = [(smoothed_data_format % (layer_id, min_mag),
+                      layer_id, layer, min_mag, use_recomputed)
+                     for min_mag in MIN_MAGS
+                     for layer_id, layer in layers_completeness_df.iterrows()]
+    with ThreadPoolExecutor(max_workers=len(smoothed_jobs)) as executor:
+        smoothed_df_list = list(executor.map(_read_smoothed,
+                                             *zip(*smoothed_jobs)))
 
     smoothed_df = pd.concat(smoothed_df_list, ignore_index=True)
     len_smoothed = smoothed_df.shape[0]
-    smoothed_df.sort_values(['layerid', 'mmin model', 'longitude', 'latitude'])
-    smoothed_df['geometry'] = [Point(longitude, latitude)
-                               for longitude, latitude
-                               in zip(smoothed_df['longitude'],
-                                      smoothed_df['latitude'])]
-    smoothed_df = gpd.GeoDataFrame(smoothed_df, crs='WGS84')
+    smoothed_df = gpd.GeoDataFrame(
+        smoothed_df, crs='WGS84',
+        geometry=gpd.points_from_xy(smoothed_df['longitude'].values,
+                                    smoothed_df['latitude'].values))
 
     print('Read %d point sources from %d files: %s\n' %
           (len(smoothed_df), len(MIN_MAGS)*len(layers_df),
@@ -302,23 +316,25 @@ def write_source_models(version=0, full=False, use_recomputed=False,
     mark = time()
 
     smoothed_df['distance'] = np.inf
-    smoothed_dfs = []
-    for layer_id in layers_df.index:
-        smoothed_layer_df = smoothed_df[smoothed_df['layerid'] == layer_id]
-        areal_layer_df = gpd.GeoDataFrame(
-            active_areal_df[active_areal_df['layerid'] == layer_id],
-            crs='WGS84')
-        smoothed_layer_df = gpd.sjoin(
-            smoothed_layer_df, areal_layer_df[['zoneid', 'a', 'geometry']],
-            how='left', op='within')
-        smoothed_dfs.append(smoothed_layer_df)
-    smoothed_df = pd.concat(smoothed_dfs)
-    smoothed_df.drop(columns='index_right', inplace=True)
+    # one spatial index over zones of all layers, then discard matches
+    # between a point and a zone in a different layer
+    areal_zones_df = gpd.GeoDataFrame(
+        active_areal_df[['layerid', 'zoneid', 'a', 'geometry']].rename(
+            columns={'layerid': 'zone layerid'}),
+        crs='WGS84')
+    joined_df = gpd.sjoin(smoothed_df[['layerid', 'geometry']],
+                          areal_zones_df, how='inner', op='within')
+    joined_df = joined_df[joined_df['layerid'] == joined_df['zone layerid']]
+    smoothed_df = smoothed_df.join(joined_df[['zoneid', 'a']], how='left')
+
+    # point geometries are not needed beyond the spatial join
+    smoothed_df = pd.DataFrame(smoothed_df.drop(columns='geometry'))
 
     smoothed_df['in zoneid'] = smoothed_df['zoneid'].copy()
 
     assigned = (~np.isnan(smoothed_df['in zoneid'])) & (smoothed_df['a'] != 0)
-    smoothed_df.loc[assigned, 'distance'] = 0
+    smoothed_df['distance'] = np.where(assigned.values, 0,
+                                       smoothed_df['distance'].values)
     print('Spatial join accounted for %.2f%% of sources: %s\n' %
           (100*len(smoothed_df[assigned])/len(smoothed_df),
            pd.to_timedelta(time() - mark, unit='s')))
@@ -364,24 +380,26 @@ def write_source_models(version=0, full=False, use_recomputed=False,
     # associate points nearest to zones
     print('Find nearest areal zones for remaining points ...')
     mark = time()
-    active_areal_df['polygon'] = [
-        MyPolygon([geo.point.Point(lat, lon)
-                   for lat, lon in zip(*zone.geometry.exterior.coords.xy)])
-        for _, zone in active_areal_df.iterrows()]
+    active_areal_df['polygon'] = [_cached_polygon(zone)
+                                  for zone in active_areal_df['geometry']]
 
+    # only zones in the same layer compete
     unassigned_df = smoothed_df.loc[~assigned].copy()
-    distances = np.full((len(unassigned_df),
-                         len(active_areal_df)), np.inf)
-    for i, area_series in active_areal_df.iterrows():
-        in_layer = (unassigned_df['layerid'] == area_series['layerid']).values
-        mesh = geo.mesh.Mesh(
+    nearest_zoneid = np.full(len(unassigned_df), np.nan)
+    nearest_distance = np.full(len(unassigned_df), np.inf)
+    for layer_id, layer_areal_df in active_areal_df.groupby('layerid'):
+        in_layer = (unassigned_df['layerid'] == layer_id).values
+        if not in_layer.any():
+            continue
+        nearest, distance = nearest_polygons(
+            layer_areal_df['polygon'].tolist(),
             unassigned_df.loc[in_layer, 'longitude'].values,
             unassigned_df.loc[in_layer, 'latitude'].values)
-        distances[in_layer, i] = area_series['polygon'].distances(mesh)
+        nearest_zoneid[in_layer] = layer_areal_df['zoneid'].values[nearest]
+        nearest_distance[in_layer] = distance
 
-    unassigned_df.loc[:, 'zoneid'] = active_areal_df.loc[
-        np.argmin(distances, axis=1), 'zoneid'].values
-    unassigned_df.loc[:, 'distance'] = np.amin(distances, axis=1)
+    unassigned_df.loc[:, 'zoneid'] = nearest_zoneid
+    unassigned_df.loc[:, 'distance'] = nearest_distance
 
     print('Nearest zone required for %.0f%% of sources: %s\n' %
           (100*len(unassigned_df)/len(smoothed_df),
@@ -398,8 +416,9 @@ def write_source_models(version=0, full=False, use_recomputed=False,
     smoothed_df.drop(columns=['a'], inplace=True)
     smoothed_df = smoothed_df.merge(active_areal_df[columns_to_copy],
                                     on='zoneid')
-    smoothed_df['a'] = (np.log10(smoothed_df['lambda']) +
-                        smoothed_df['b']*smoothed_df['mmin model'])
+    smoothed_df['a'] = (np.log10(smoothed_df['lambda'].values) +
+                        smoothed_df['b'].values *
+                        smoothed_df['mmin model'].values)
     assert len_smoothed == smoothed_df.shape[0]
 
     # check for unassigned parameters
@@ -424,10 +443,14 @@ def write_source_models(version=0, full=False, use_recomputed=False,
         raise RuntimeError('Unassigned parameters remain.')
 
     # Thinning of models allows quick testing and git archiving of a sample
+    # (grid coordinates are regular, so compare them as integer hundredths)
     res_deg = 1
+    scale = 100
+    step = int(round(res_deg*scale))
+    lat_i = np.rint(smoothed_df['latitude'].values*scale).astype(np.int32)
+    lon_i = np.rint(smoothed_df['longitude'].values*scale).astype(np.int32)
     thinned_df = smoothed_df.loc[
-        np.isclose(np.remainder(smoothed_df['latitude'], res_deg), 0) &
-        np.isclose(np.remainder(smoothed_df['longitude'], res_deg), 0)].copy()
+        (lat_i % step == 0) & (lon_i % step == 0)].copy()
     print('Thinning to %g° spacing reduces number of points from %d to %d.\n'
           % (res_deg, len(smoothed_df), len(thinned_df)))
 
@@ -9,26 +9,27 @@ import numpy as np
 
 
 def width_from_dip(dip, depth):
-    return depth/np.sin(np.deg2rad(dip))
+    return np.asarray(depth, dtype=float)/np.sin(np.deg2rad(dip))
 
 
 def area_scaling(magnitude, relation='WC1994'):
-    if msr == 'StrasserInterface':
+    magnitude = np.asarray(magnitude, dtype=float)
+    if relation == 'StrasserInterface':
         return 10**(-3.99 + 0.98*magnitude)
     else:
         return 10**(-3.476 + 0.952*magnitude)
 
 
 magnitude = 9.0
+msrs = ['WC1994'] + ['StrasserInterface']*4
+depths = np.array([25, 25, 70, 20, 25])
+dips = np.array([78, 78, 78, 10, 12.6])
 
-for msr, depth, dip in zip(
-        ['WC1994'] + ['StrasserInterface']*4,
-        [25, 25, 70, 20, 25],
-        [78, 78, 78, 10, 12.6]):
+widths = width_from_dip(dips, depths)
 
-    area = area_scaling(magnitude, msr)
+for msr, depth, dip, width in zip(msrs, depths, dips, widths):
 
-    width = width_from_dip(dip, depth)
+    area = area_scaling(magnitude, relation=msr)
     length = area/width
 
     print('M%.1f, %s, %g° dip, %g km depth:' %
@@ -12,6 +12,7 @@ This is simply a wrapper around catalogue_tools.npf2cat.npf2cat().
 import os
 import sys
 from argparse import ArgumentParser
+from contextlib import contextmanager
 
 import numpy as np
 import pandas as pd
@@ -27,6 +28,31 @@ from toolbox import convert_probability, logspace, read_hazard_map_csv
 FILE_NAME = os.path.basename(__file__)
 IMT_POE_FMT = '%s, %.3g%%/%gy'
 
+GDAL_CONFIG = {
+    'GDAL_CACHEMAX': '1024',
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'GDAL_NUM_THREADS': 'ALL_CPUS',
+}
+TILE_SIZE = 256
+GTIFF_OPTIONS = ['INTERLEAVE=BAND', 'TILED=YES', 'COMPRESS=DEFLATE',
+                 'PREDICTOR=3', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER',
+                 'BLOCKXSIZE=%d' % TILE_SIZE, 'BLOCKYSIZE=%d' % TILE_SIZE]
+
+
+@contextmanager
+def _gdal_config(options):
+    '''
+    Temporarily set GDAL configuration options, restoring previous values.
+    '''
+    previous = {key: gdal.GetConfigOption(key) for key in options}
+    for key, value in options.items():
+        gdal.SetConfigOption(key, value)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            gdal.SetConfigOption(key, value)
+
 
 def _label(i, edges):
     if i == 0:
@@ -77,6 +103,13 @@ def csv2raster(input_file, raster_fmt='GTiff', crs='EPSG:4326',
 
     grid_step = np.mean(np.diff(lons))
 
+    # all bands at once, as a cube indexed by imt, poe, lat & lon
+    df_all = df_all.reindex(
+        index=pd.MultiIndex.from_product([lons, lats]),
+        columns=pd.MultiIndex.from_product([imts, poes_inv]))
+    cube = df_all.values.reshape(
+        len(lons), len(lats), len(imts), len(poes_inv)).transpose(2, 3, 1, 0)
+
     srs = osr.SpatialReference()
     srs.SetFromUserInput(crs)
     projection_wkt = srs.ExportToWkt()
@@ -89,22 +122,39 @@ def csv2raster(input_file, raster_fmt='GTiff', crs='EPSG:4326',
     raster_file = os.path.splitext(input_file)[0] + '.' + raster_ext
     print('Saving: ' + raster_file)
 
-    ds = gdal.GetDriverByName(raster_fmt).Create(
-        raster_file, len(lons), len(lats), df_all.shape[1], gdal.GDT_Float64)
-    ds.SetProjection(projection_wkt)
-    ds.SetGeoTransform([lons.min(), grid_step, 0, lats.min(), 0, grid_step])
-
-    band_number = 1
-    for imt in imts:
-        for poe_inv, poe in zip(poes_inv, poes):
-            df = df_all[(imt, poe_inv)].unstack().T
-            band = ds.GetRasterBand(band_number)
-            band.WriteArray(df.values)
-            band.SetDescription(IMT_POE_FMT % (imt, 100*poe,
-                                               investigation_time))
-            band_number += 1
-
-    ds.FlushCache()
+    if raster_ext == 'tif':
+        # whole tiles of band-sequential data bypass the GDAL block cache
+        options = GTIFF_OPTIONS
+    else:
+        options = []
+
+    with _gdal_config(GDAL_CONFIG):
+        ds = gdal.GetDriverByName(raster_fmt).Create(
+            raster_file, len(lons), len(lats), df_all.shape[1],
+            gdal.GDT_Float64, options=options)
+        ds.SetProjection(projection_wkt)
+        ds.SetGeoTransform([lons.min(), grid_step, 0,
+                            lats.min(), 0, grid_step])
+
+        # write all bands a tile at a time, copying only one tile of the
+        # cube into band-sequential order at once
+        for y_off in range(0, len(lats), TILE_SIZE):
+            for x_off in range(0, len(lons), TILE_SIZE):
+                tile = np.ascontiguousarray(
+                    cube[:, :, y_off:y_off + TILE_SIZE,
+                         x_off:x_off + TILE_SIZE], dtype=np.float64)
+                ds.WriteRaster(x_off, y_off, tile.shape[-1], tile.shape[-2],
+                               tile.tobytes(), buf_type=gdal.GDT_Float64)
+
+        band_number = 1
+        for imt in imts:
+            for poe in poes:
+                ds.GetRasterBand(band_number).SetDescription(
+                    IMT_POE_FMT % (imt, 100*poe, investigation_time))
+                band_number += 1
+
+        ds.FlushCache()
+        ds = None
 
     if not plot_fmt:
         return raster_file
@@ -113,18 +163,18 @@ def csv2raster(input_file, raster_fmt='GTiff', crs='EPSG:4326',
     print('Saving: ' + image_file)
 
     if sites_table:
-        df_cities = pd.read_csv(sites_table, skiprows=1, index_col='City')
+        df_cities = pd.read_csv(
+            sites_table, skiprows=1, index_col='City',
+            usecols=['City', 'Longitude (°E)', 'Latitude (°N)'],
+            dtype={'Longitude (°E)': np.float64, 'Latitude (°N)': np.float64})
 
     x = np.hstack((lons - grid_step/2, lons[-1] + grid_step/2))
     y = np.hstack((lats - grid_step/2, lats[-1] + grid_step/2))
 
-    if not symmetric:
-        boundaries = logspace(limits[0], limits[1], bins_per_decade)
-    else:
-        boundaries = logspace(limits[0], limits[1], 2*bins_per_decade)
-        boundaries = np.array(sorted(
-            set(logspace(limits[0], limits[1], 2*bins_per_decade)) -
-            set(logspace(limits[0], limits[1], bins_per_decade))))
+    boundaries = logspace(limits[0], limits[1], bins_per_decade)
+    if symmetric:
+        boundaries = np.setdiff1d(
+            logspace(limits[0], limits[1], 2*bins_per_decade), boundaries)
 
     cmap = plt.cm.get_cmap(colormap, len(boundaries) - 1)
     cmap.set_over('0.7')
@@ -136,14 +186,13 @@ def csv2raster(input_file, raster_fmt='GTiff', crs='EPSG:4326',
         figsize=(axsize[0]*len(poes_inv), axsize[1]*len(imts)),
         subplot_kw=dict(aspect='equal', adjustable='box'))
 
-    for imt, row_axes in zip(imts, axes):
-        for poe_inv, poe, ax in zip(poes_inv, poes, row_axes):
+    for imt, imt_cube, row_axes in zip(imts, cube, axes):
+        for poe, values, ax in zip(poes, imt_cube, row_axes):
 
             ax.annotate(IMT_POE_FMT % (imt, 100*poe, investigation_time),
                         xy=(0.05, 0.05), xycoords='axes fraction')
 
-            df = df_all[(imt, poe_inv)].unstack().T
-            im = ax.pcolormesh(x, y, df.values, cmap=cmap, norm=norm)
+            im = ax.pcolormesh(x, y, values, cmap=cmap, norm=norm)
 
             if sites_table:
                 ax.plot(df_cities['Longitude (°E)'],
@@ -183,7 +232,7 @@ def csv2raster(input_file, raster_fmt='GTiff', crs='EPSG:4326',
     cmap_df = pd.DataFrame(
         np.vstack((
             cmap._rgba_under,
-            np.vstack(cmap(i) for i in range(cmap.N)),
+            cmap(np.arange(cmap.N)),
             cmap._rgba_over)),
         columns=['R', 'G', 'B', 'A'],
         index=np.arange(cmap.N + 2))
@@ -191,7 +240,8 @@ def csv2raster(input_file, raster_fmt='GTiff', crs='EPSG:4326',
     # cmap_df.drop(cmap_df.index[-1], inplace=True)
     # cmap_df.drop(cmap_df.index[-1], inplace=True)
     cmap_df.insert(0, 'upper', np.hstack((boundaries, np.Inf)))
-    cmap_df['label'] = [_label(i, cmap_df['upper']) for i in cmap_df.index]
+    edges = cmap_df['upper'].values
+    cmap_df['label'] = [_label(i, edges) for i in range(len(edges))]
 
     if os.path.isfile(colormap_file):
         os.remove(colormap_file)
@@ -27,6 +27,9 @@ Module exports:
 """
 
 import os
+from functools import lru_cache
+from itertools import product
+
 import numpy as np
 import pandas as pd
 import toolbox as tb
@@ -39,22 +42,38 @@ def is_imt(value):
     if tb.is_numeric(value):
         return True
     else:
-        try:
-            imt.from_string(value.upper())
-            return True
-        except ValueError:
-            return False
+        return _is_imt_string(value)
+
+
+@lru_cache(maxsize=None)
+def _is_imt_string(value):
+    """Check if string names an intensity measure type, memoized."""
+    if not value[:1].isalpha():
+        return False
+    try:
+        imt.from_string(value.upper())
+        return True
+    except ValueError:
+        return False
 
 
 def get_imt(value):
     """Get intensity measure type corresponding to value."""
     if tb.is_numeric(value):
-        return imt.from_string('SA(%g)' % float(value))
+        return _get_imt_string('SA(%g)' % float(value))
     else:
-        try:
-            return imt.from_string(value.upper())
-        except ValueError:
-            return None
+        return _get_imt_string(value)
+
+
+@lru_cache(maxsize=None)
+def _get_imt_string(value):
+    """Get intensity measure type named by string, memoized."""
+    if not value[:1].isalpha():
+        return None
+    try:
+        return imt.from_string(value.upper())
+    except ValueError:
+        return None
 
 
 def choose_attribute(prefix, preferred, required):
@@ -118,66 +137,65 @@ def compute_gmpe(gmpe, mags, ruptures, distances, sites, im_types,
         sites = 0
 
     # cast inputs into numpy arrays
-    sites = np.asarray([sites], dtype='float').reshape((-1,))
-    distances = np.asarray([distances], dtype='float').reshape((-1,))
+    sites = np.asarray(sites, dtype='float').ravel()
+    distances = np.asarray(distances, dtype='float').ravel()
 
     # set up some reusable contexts
     rctx = gsim.base.RuptureContext()
     sctx = gsim.base.SitesContext()
     dctx = gsim.base.DistancesContext()
 
-    empty = True
-    for mag in np.asarray([mags], dtype='float').reshape((-1,)):
-        for rupture in np.asarray([ruptures], dtype='float').reshape((-1,)):
-
-            rctx.mag = mag
-            if rup_attr is not None:
-                setattr(rctx, rup_attr, rupture)
-            setattr(dctx, dist_attr, np.tile(distances, sites.size))
-            if site_attr is not None:
-                setattr(sctx, site_attr, np.repeat(sites, distances.size))
-
-            for i, im_type in enumerate(im_types):
-
-                mean, [stddev] = gmpe.get_mean_and_stddevs(
-                    sctx, rctx, dctx, im_type, [std_type])
-
-                if i == 0:
-                    df_mean = pd.DataFrame({
-                        'gmpe': gmpe.__class__.__name__,
-                        'rup_mag': np.full_like(mean, rctx.mag),
-                        dist_col: getattr(dctx, dist_attr),
-                        'damping': damping,
-                        })
-                    if site_col is not None:
-                        df_mean[site_col] = sctx.vs30
-                    if rup_col is not None:
-                        df_mean[rup_col] = np.full_like(
-                            mean, getattr(rctx, rup_attr))
-
-                    df_stddev = df_mean.copy()
-                    df_mean['result_type'] = 'MEAN'
-                    df_stddev['result_type'] = std_result_type
-
-                if isinstance(im_type, imt.SA):
-                    imt_key = im_type.period
-                else:
-                    imt_key = str(im_type)
-                df_mean[imt_key] = np.exp(mean)
-                df_stddev[imt_key] = stddev
-
-            if empty:
-                df_means = df_mean
-                df_stddevs = df_stddev
-                empty = False
-            else:
-                df_means = pd.concat((df_means, df_mean),
-                                     ignore_index=True)
-                df_stddevs = pd.concat((df_stddevs, df_stddev),
-                                       ignore_index=True)
+    # distances and sites are the same for every rupture, and are already
+    # evaluated in one call; magnitude and rupture attributes must stay
+    # scalar because many GMPEs branch on them
+    setattr(dctx, dist_attr, np.tile(distances, sites.size))
+    if site_attr is not None:
+        setattr(sctx, site_attr, np.repeat(sites, distances.size))
 
-    df_means = df_massage(df_means)
-    df_stddevs = df_massage(df_stddevs)
+    mean_frames, stddev_frames = [], []
+    for mag, rupture in product(
+            np.asarray(mags, dtype='float').ravel(),
+            np.asarray(ruptures, dtype='float').ravel()):
+
+        rctx.mag = mag
+        if rup_attr is not None:
+            setattr(rctx, rup_attr, rupture)
+
+        means, stddevs = {}, {}
+        for im_type in im_types:
+
+            mean, [stddev] = gmpe.get_mean_and_stddevs(
+                sctx, rctx, dctx, im_type, [std_type])
+
+            if isinstance(im_type, imt.SA):
+                imt_key = im_type.period
+            else:
+                imt_key = str(im_type)
+            means[imt_key] = np.exp(mean)
+            stddevs[imt_key] = stddev
+
+        # mean and stddev frames share the same context columns
+        columns = {
+            'gmpe': gmpe.__class__.__name__,
+            'rup_mag': rctx.mag,
+            dist_col: getattr(dctx, dist_attr),
+            'damping': damping,
+            }
+        if site_col is not None:
+            columns[site_col] = sctx.vs30
+        if rup_col is not None:
+            columns[rup_col] = getattr(rctx, rup_attr)
+
+        for frames, results, result_type in [
+                (mean_frames, means, 'MEAN'),
+                (stddev_frames, stddevs, std_result_type)]:
+            frame_columns = columns.copy()
+            frame_columns['result_type'] = result_type
+            frame_columns.update(results)
+            frames.append(pd.DataFrame(frame_columns))
+
+    df_means = df_massage(pd.concat(mean_frames, ignore_index=True))
+    df_stddevs = df_massage(pd.concat(stddev_frames, ignore_index=True))
 
     return (df_means, df_stddevs)
 
@@ -215,16 +233,21 @@ def df_massage(df_ref):
 
     # determine sensible column ordering
     cols_ref = df_ref.columns
-    sa_cols = np.array([tb.is_numeric(item) for item in cols_ref])
-    imt_cols = np.array([is_imt(item) for item in cols_ref]) & ~sa_cols
-    gmpe_cols = np.array([(isinstance(item, str) and ('gmpe' in item))
-                          for item in cols_ref])
-    rup_cols = np.array([(isinstance(item, str) and ('rup_' in item))
-                         for item in cols_ref])
-    dist_cols = np.array([(isinstance(item, str) and ('dist_' in item))
-                          for item in cols_ref])
-    site_cols = np.array([(isinstance(item, str) and ('site_' in item))
-                          for item in cols_ref])
+    sa_cols = np.zeros(len(cols_ref), dtype=bool)
+    imt_cols, gmpe_cols, rup_cols, dist_cols, site_cols = (
+        np.zeros_like(sa_cols) for _ in range(5))
+    for i, item in enumerate(cols_ref):
+        if tb.is_numeric(item):
+            sa_cols[i] = True
+        elif isinstance(item, str):
+            gmpe_cols[i] = 'gmpe' in item
+            rup_cols[i] = 'rup_' in item
+            dist_cols[i] = 'dist_' in item
+            site_cols[i] = 'site_' in item
+            # no intensity measure type name contains these substrings
+            if not (gmpe_cols[i] or rup_cols[i] or dist_cols[i] or
+                    site_cols[i]):
+                imt_cols[i] = _is_imt_string(item)
     other_cols = ~gmpe_cols & ~rup_cols & ~dist_cols & \
                  ~site_cols & ~imt_cols & ~sa_cols
 
@@ -274,30 +297,27 @@ def write_test_data(df_results, gmpe_group, gmpes_short, gmpe_class_names,
     df_results = df_massage(df_results)
 
     output_files = []
-    for gmpe_name in sorted(list(set(df_results['gmpe']))):
-        for result_type in sorted(list(set(df_results['result_type']))):
-
-            gmpe_short = [short
-                          for short, name in zip(gmpes_short, gmpe_class_names)
-                          if gmpe_name == name][0]
-
-            # construct output file name
-            output_file = '%s_%s_%s' % (gmpe_group, gmpe_short, result_type)
-            if group_name:
-                output_file += '_' + group_name
-            output_file = output_file.replace('__', '_')
-            output_file += '.csv'
-            output_file = os.path.join(test_path, output_file)
-
-            indices = df_results['gmpe'] == gmpe_name
-            if len(indices) > 0:
-                df_gmpe = df_results[indices].copy()
-                df_gmpe.drop(['gmpe'], axis=1, inplace=True)
-                df_gmpe.drop_duplicates(inplace=True)
-                df_gmpe = df_massage(df_gmpe)
-                df_gmpe.to_csv(output_file, index=False,
-                               float_format=float_format)
-                output_files.append(output_file)
+    for (gmpe_name, result_type), df_gmpe in df_results.groupby(
+            ['gmpe', 'result_type']):
+
+        gmpe_short = [short
+                      for short, name in zip(gmpes_short, gmpe_class_names)
+                      if gmpe_name == name][0]
+
+        # construct output file name
+        output_file = '%s_%s_%s' % (gmpe_group, gmpe_short, result_type)
+        if group_name:
+            output_file += '_' + group_name
+        output_file = output_file.replace('__', '_')
+        output_file += '.csv'
+        output_file = os.path.join(test_path, output_file)
+
+        # already ordered by df_massage above, but results missing for this
+        # GMPE should not be written
+        df_gmpe = df_gmpe.drop(columns='gmpe').drop_duplicates()
+        df_gmpe = df_gmpe.dropna(axis=1, how='all')
+        df_gmpe.to_csv(output_file, index=False, float_format=float_format)
+        output_files.append(output_file)
 
     return output_files
 
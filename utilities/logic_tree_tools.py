@@ -26,8 +26,12 @@ import re
 import ast
 from string import Template
 
+import shutil
+import tempfile
 import subprocess
-from copy import deepcopy
+from copy import copy, deepcopy
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -49,15 +53,36 @@ def read_tree_tsv(file_tsv, delimiter='\t'):
     tree_df = pd.read_csv(file_tsv, delimiter=delimiter)
     for key in ['uncertaintyModel', 'uncertaintyWeight']:
         if key in tree_df.columns:
-            for _, branch_set in tree_df.iterrows():
-                branch_set[key] = ast.literal_eval(branch_set[key])
+            tree_df[key] = tree_df[key].map(ast.literal_eval)
     return tree_df
 
 
+def _iterdicts(df):
+    '''
+    Like :meth:`pandas.DataFrame.iterrows` but yields plain dicts, avoiding
+    the construction of a :class:`pandas.Series` for every row.
+    '''
+    columns = df.columns.tolist()
+    for values in df.itertuples(index=False, name=None):
+        yield dict(zip(columns, values))
+
+
 MODEL_LENGTHS = {'bGRRelative': 1, 'maxMagGRRelative': 1,
                  'maxMagGRAbsolute': 1, 'abGRAbsolute': 2}
 
 
+@lru_cache(maxsize=1024)
+def _is_valid_gsim(model):
+    '''
+    Check whether OpenQuake recognises a GSIM, remembering the answer.
+    '''
+    try:
+        nrml.valid.gsim(model)
+    except ValueError:
+        return False
+    return True
+
+
 def models_with_weights(uncertainty_type, models, weights=None,
                         prefix=None, validate=True, omit=None, sub=None):
     '''
@@ -95,9 +120,7 @@ def models_with_weights(uncertainty_type, models, weights=None,
                 in reversed(list(zip(range(len(models)), model_weights))):
 
             if uncertainty_type == 'gmpeModel':
-                try:
-                    nrml.valid.gsim(model)
-                except ValueError:
+                if not _is_valid_gsim(model):
                     print('%s not valid GSIM. Omitting ...' %
                           name(i, model, prefix))
                     model_weights.pop(i)
@@ -106,12 +129,15 @@ def models_with_weights(uncertainty_type, models, weights=None,
                     print('%s not found. Omitting ...' %
                           name(i, model, prefix))
                     model_weights.pop(i)
-            elif uncertainty_type in MODEL_LENGTHS.keys():
+            elif uncertainty_type in MODEL_LENGTHS:
                 req_size = MODEL_LENGTHS[uncertainty_type]
-                if np.array(model).size != req_size:
+                if isinstance(model, (list, tuple)):
+                    size = len(model)
+                else:
+                    size = np.size(model)
+                if size != req_size:
                     print('%s has elements %d instead of %d. Omitting ...' %
-                          (name(i, model, prefix), np.array(model).size,
-                           req_size))
+                          (name(i, model, prefix), size, req_size))
                     model_weights.pop(i)
             else:
                 print('Unknown uncertainty type: %s', uncertainty_type)
@@ -119,10 +145,13 @@ def models_with_weights(uncertainty_type, models, weights=None,
 
     if model_weights:
         models, weights = zip(*model_weights)
-        if weights:
-            weights = np.array(weights).astype(float)
-            weights = (weights/np.sum(weights)).round(3)
-            weights[0] = (1 - np.sum(weights[1:])).round(3)
+        if len(weights) == 1:
+            weights = [1.]
+        else:
+            weights = np.asarray(weights, dtype=float)
+            weights /= weights.sum()
+            np.round(weights, 3, out=weights)
+            weights[0] = round(1 - weights[1:].sum(), 3)
             weights = weights.tolist()
         model_weights = zip(models, weights)
 
@@ -174,6 +203,12 @@ _BRANCH_STRING = '''\
                     </uncertaintyWeight>
                 </logicTreeBranch>'''
 
+_NRML_TEMPLATE = Template(_NRML_STRING)
+_LOGIC_TREE_TEMPLATE = Template(_LOGIC_TREE_STRING)
+_BRANCH_LEVEL_TEMPLATE = Template(_BRANCH_LEVEL_STRING)
+_BRANCH_SET_TEMPLATE = Template(_BRANCH_SET_STRING)
+_BRANCH_TEMPLATE = Template(_BRANCH_STRING)
+
 
 @deprecated('Use gsim_data_to_tree instead')
 def write_gsim_tree_nrml(tree_df, output_file,
@@ -182,56 +217,65 @@ def write_gsim_tree_nrml(tree_df, output_file,
     Deprecated. Does the same job as :func:`gsim_data_to_tree`, but in a
     less robust way.
     '''
-    branch_template = Template(_BRANCH_STRING)
-    branch_set_template = Template(_BRANCH_SET_STRING)
-    branch_level_template = Template(_BRANCH_LEVEL_STRING)
-
     branching_level_list = []
-    for i, level in tree_df.iterrows():
+    for i, level in zip(tree_df.index, tree_df.itertuples(index=False)):
 
         models_weights = models_with_weights(
-            'gmpeModel', level['uncertaintyModel'], weights=None,
+            'gmpeModel', level.uncertaintyModel, weights=None,
             prefix='Level %d' % (i + 1), validate=validate, omit=omit, sub=sub)
 
-        branch_list = []
-        for j, (model, weight) in enumerate(models_weights):
-            branch_list += [branch_template.substitute(
-                BRANCH_ID='r%dm%d' % (i + 1, j + 1),
+        branch_prefix = 'r%dm' % (i + 1)
+        branch_list = [
+            _BRANCH_TEMPLATE.substitute(
+                BRANCH_ID=branch_prefix + str(j + 1),
                 VALUE=model,
-                WEIGHT=weight)]
+                WEIGHT=weight)
+            for j, (model, weight) in enumerate(models_weights)]
 
-        branch_set = branch_set_template.substitute(
+        branch_set = _BRANCH_SET_TEMPLATE.substitute(
             BRANCH_SET_ID='bs%d' % (i + 1),
             UNCERTAINTY_TYPE='gmpeModel',
-            TECTONIC_REGION_TYPE=level['applyToTectonicRegionType'],
+            TECTONIC_REGION_TYPE=level.applyToTectonicRegionType,
             BRANCHES='\n'.join(branch_list))
-        branching_level_list += [branch_level_template.substitute(
+        branching_level_list.append(_BRANCH_LEVEL_TEMPLATE.substitute(
             BRANCHING_LEVEL_ID='bl%d' % (i + 1),
-            BRANCH_SETS=branch_set)]
+            BRANCH_SETS=branch_set))
 
-    content = Template(_LOGIC_TREE_STRING).substitute(
+    content = _LOGIC_TREE_TEMPLATE.substitute(
         LOGIC_TREE_ID='lt1',
         BRANCHING_LEVELS='\n'.join(branching_level_list))
-    document = Template(_NRML_STRING).substitute(CONTENT=content)
+    document = _NRML_TEMPLATE.substitute(CONTENT=content)
 
     with open(output_file, 'w') as file_obj:
         file_obj.write(document)
 
 
+_BRACKETS = re.compile(r'[\[\]]')
+_BRACKETS_OPERATORS = re.compile(r'[\[\]+,-]')
+
+
+@lru_cache(maxsize=None)
+def _key_pattern(key):
+    '''
+    Compiled regular expression matching key as a whole word.
+    '''
+    return re.compile(r'\b' + re.escape(key) + r'\b')
+
+
 def get_template_keys(symoblic_model, all_keys):
     '''
     Parse template and check which keys are needed to evaluate it.
     '''
     template = str(symoblic_model).replace("'", '')
-    labels = re.sub(r'[\[\]]', '', template).split(',')
-    labels = [label.strip() for label in labels]
-    required_keys = set(re.sub(r'[\[\]+,-]', '', template).split())
+    labels = [label.strip()
+              for label in _BRACKETS.sub('', template).split(',')]
+    required_keys = set(_BRACKETS_OPERATORS.sub('', template).split())
 
     for key in list(required_keys):
         if key not in all_keys:
             if key != '0':
                 print('Cannot find %s in keys, setting to zero' % key)
-            template = re.sub(r'\b' + key + r'\b', '0', template)
+            template = _key_pattern(key).sub('0', template)
             required_keys.discard(key)
 
     return template, required_keys, labels
@@ -243,7 +287,7 @@ def eval_symbolic_model(template, required_keys, series):
     Returns list of numbers.
     '''
     for key in required_keys:
-        template = re.sub(r'\b%s\b' % key, str(series[key]), template)
+        template = _key_pattern(key).sub(str(series[key]), template)
 
     return np.array(ast.literal_eval(template)).round(6).tolist()
 
@@ -252,32 +296,32 @@ def expand_sources(df_in):
     '''
     For a source model logic tree expand source-specific branches
     '''
-    df_out = pd.DataFrame()
-    for _, row_in in df_in.iterrows():
+    records = []
+    for row_in in _iterdicts(df_in):
 
         apply_to = row_in['applyToSources']
 
         if not os.path.isfile(apply_to):
             # just pass the branch level through unmolested
-            row_out = row_in.copy()
-            df_out = df_out.append(row_out)
+            records.append(row_in)
             continue
 
         # when "apply to" is a source table file, add branch level for each row
         df_sources = csv2df(apply_to)
-        df_sources = add_name_id(df_sources)
+        df_sources = add_name_id(df_sources, inplace=True)
         df_sources = twin_source_by_magnitude(df_sources)
         df_sources = natural_sort(df_sources, by='id')
 
         template, required_keys, _ = get_template_keys(
             row_in['uncertaintyModel'], df_sources.columns)
 
-        for _, source in df_sources.iterrows():
+        source_ids = set(df_sources['id'])
+        for source in _iterdicts(df_sources):
             if source['mmax'] == 0:
                 continue
 
             # no mmax uncertainty on zones with megathrust twins
-            if (any(source['id'] + 'm' == df_sources['id']) and
+            if (source['id'] + 'm' in source_ids and
                     (row_in['uncertaintyType'][:6] == 'maxMag')):
                 continue
 
@@ -286,8 +330,9 @@ def expand_sources(df_in):
             row_out = row_in.copy()
             row_out['applyToSources'] = source['id']
             row_out['uncertaintyModel'] = model
-            df_out = df_out.append(row_out)
+            records.append(row_out)
 
+    df_out = pd.DataFrame.from_records(records, columns=df_in.columns)
     all_sources = df_out['applyToSources'] == 'all'
     df_out = pd.concat((df_out[all_sources], df_out[~all_sources]))
     df_out.index = range(len(df_out))
@@ -295,20 +340,38 @@ def expand_sources(df_in):
     return df_out
 
 
-def branch_mfds(mfds_in, weights_in, labels_in, branch, zone):
+def _clone_mfd(mfd):
+    '''
+    Copy an MFD so that it can be modified without affecting the original.
+    Truncated Gutenberg-Richter MFDs hold only scalars so a shallow copy
+    suffices.
+    '''
+    if type(mfd) is TruncatedGRMFD:
+        return copy(mfd)
+
+    return deepcopy(mfd)
+
+
+def branch_mfds(mfds_in, weights_in, labels_in, branch, zone,
+                template_keys=None):
     '''
     Apply a branch of a logic tree to existing mfds and cumulate weights.
+
+    The output of :func:`get_template_keys` for this branch may be passed as
+    template_keys to avoid parsing the template again for every zone.
     '''
-    template, required_keys, labels = get_template_keys(
-        branch['uncertaintyModel'], zone.keys())
+    if template_keys is None:
+        template_keys = get_template_keys(
+            branch['uncertaintyModel'], zone.keys())
+    template, required_keys, labels = template_keys
     models = eval_symbolic_model(template, required_keys, zone)
     weights = branch['uncertaintyWeight']
 
-    if branch['uncertaintyType'] in MODEL_LENGTHS.keys():
+    if branch['uncertaintyType'] in MODEL_LENGTHS:
         mfds_out, weights_out, labels_out = [], [], []
         for mfd_in, weight_in, label_in in zip(mfds_in, weights_in, labels_in):
             for model, weight, label in zip(models, weights, labels):
-                mfd = deepcopy(mfd_in)
+                mfd = _clone_mfd(mfd_in)
 
                 if mfd is not None:
                     if branch['uncertaintyType'] == 'bGRRelative':
@@ -347,16 +410,15 @@ def get_rates(mfds):
     '''
     Convert list of MFDs to matrix of occurrence rates.
     '''
-    num_rates = [int(round((mfd.get_min_max_mag()[1] -
-                            mfd.get_min_max_mag()[0])/mfd.bin_width)) + 1
-                 if mfd is not None else 0
-                 for mfd in mfds]
+    branch_rates = [
+        np.fromiter((rate for _, rate in mfd.get_annual_occurrence_rates()),
+                    dtype=np.float64)
+        if mfd is not None else np.zeros(0)
+        for mfd in mfds]
 
-    rates = np.zeros((max(num_rates), len(mfds)))
-    for i, mfd in enumerate(mfds):
-        if mfd is not None:
-            branch_rates = list(zip(*(mfd.get_annual_occurrence_rates())))[1]
-            rates[:len(branch_rates), i] = branch_rates
+    rates = np.zeros((max(len(rates) for rates in branch_rates), len(mfds)))
+    for i, branch_rate in enumerate(branch_rates):
+        rates[:len(branch_rate), i] = branch_rate
 
     return rates
 
@@ -368,15 +430,18 @@ def collapse_sources(source_df, source_tree_symbolic_df, bin_width=0.1):
     using those weights, add the combined MFD to the zone in the source model
     and finally remove the corresponding branch from the tree.
     '''
-    collapsible = np.array([
-        branch['uncertaintyType'] in MODEL_LENGTHS.keys()
-        for _, branch in source_tree_symbolic_df.iterrows()])
+    collapsible = source_tree_symbolic_df['uncertaintyType'].isin(
+        list(MODEL_LENGTHS)).values
+    collapsible_branches = [
+        (branch, get_template_keys(branch['uncertaintyModel'],
+                                   source_df.columns))
+        for branch in _iterdicts(source_tree_symbolic_df.loc[collapsible])]
 
     source_df = source_df.loc[(source_df['a'] != 0) &
                               (source_df['mmax'] != 0)].copy()
 
     zone_rates, all_rates, all_weights = [], [], []
-    for _, zone in source_df.iterrows():
+    for zone in _iterdicts(source_df):
 
         mfds = [TruncatedGRMFD(min_mag=zone['mmin'], max_mag=zone['mmax'],
                                a_val=zone['a'], b_val=zone['b'],
@@ -385,18 +450,18 @@ def collapse_sources(source_df, source_tree_symbolic_df, bin_width=0.1):
         labels = ['']
 
         # apply logic tree branches in successsion
-        for _, branch in source_tree_symbolic_df.loc[collapsible].iterrows():
+        for branch, template_keys in collapsible_branches:
             try:
                 mfds, weights, labels = branch_mfds(
-                    mfds, weights, labels, branch, zone)
+                    mfds, weights, labels, branch, zone, template_keys)
             except ValueError:
                 print(zone)
                 mfds, weights, labels = branch_mfds(
-                    mfds, weights, labels, branch, zone)
+                    mfds, weights, labels, branch, zone, template_keys)
         rates = get_rates(mfds)
 
         # compute the weighted sum of the rates for this zones
-        collapsed_rates = (rates*weights.reshape(1, -1)).sum(axis=1)
+        collapsed_rates = rates.dot(weights)
         zone_rates.append(limit_precision(collapsed_rates, 5))
 
         # save intermediate results from each zone for diagnostic purposes
@@ -420,7 +485,7 @@ def df_to_tree(tree_df, validate=True, omit=None, sub=None):
     '''
     tree = Node('logicTree', {'logicTreeID': 'lt1'}, None)
 
-    for i, level in tree_df.iterrows():
+    for i, level in zip(tree_df.index, _iterdicts(tree_df)):
 
         branching_level_attr = {'branchingLevelID': 'bl%d' % (i + 1)}
         branching_level = Node(
@@ -453,21 +518,25 @@ def df_to_tree(tree_df, validate=True, omit=None, sub=None):
     return tree
 
 
+_NON_DIGIT = re.compile('[^0-9]')
+
+
 def add_branch_set(branching_level, branch_set_attr, models_weights):
     '''
     Add a branch set to a branching level.
     '''
     branch_set = Node(
         'logicTreeBranchSet', branch_set_attr, None)
-    branch_index_string = re.sub('[^0-9]', '', branch_set_attr['branchSetID'])
+    branch_index_string = _NON_DIGIT.sub('', branch_set_attr['branchSetID'])
 
     if branch_index_string:
         branch_index = int(branch_index_string)
     else:
         branch_index = 999
 
-    for j, (model, weight) in enumerate(models_weights):
-        branch_attr = {'branchID': 'b%dm%d' % (branch_index, j + 1)}
+    branch_prefix = 'b%dm' % branch_index
+    for j, (model, weight) in enumerate(models_weights, 1):
+        branch_attr = {'branchID': branch_prefix + str(j)}
         branch = Node('logicTreeBranch', branch_attr, None)
         branch.append(Node('uncertaintyModel', {}, model))
         branch.append(Node('uncertaintyWeight', {}, weight))
@@ -510,7 +579,7 @@ class StreamingTexWriter(object):
     def __init__(self, stream, include_ids=False, indent=4,
                  max_branches=10, encoding='utf-8'):
         '''
-        :param stream: the stream or a file where to write the TEX
+        :param stream: the text stream or a file where to write the TEX
         :param int indent: the indentation to use in the TEX file
         '''
         self.stream = stream
@@ -521,14 +590,23 @@ class StreamingTexWriter(object):
         self.indentlevel = 0
         self.variables = None
 
+    @property
+    def indentlevel(self):
+        '''
+        Current indentation level
+        '''
+        return self._indentlevel
+
+    @indentlevel.setter
+    def indentlevel(self, value):
+        self._indentlevel = value
+        self._spaces = ' ' * (self.indent * value)
+
     def _write(self, text):
         '''
         Write text while respecting current indentation level
         '''
-        if not isinstance(text, str):
-            text = text.encode(self.encoding)
-        spaces = ' ' * (self.indent * self.indentlevel)
-        self.stream.write(spaces + text + '\n')
+        self.stream.writelines((self._spaces, text, '\n'))
 
     def start_branch(self, name, attrs=None):
         '''
@@ -551,7 +629,7 @@ class StreamingTexWriter(object):
         '''Add branch node'''
 
         tag = strip_fqtag(node.tag)
-        attrib = deepcopy(node.attrib)
+        attrib = dict(node.attrib)
         node_id = attrib.pop(get_dict_key_match(attrib, 'id'), None)
 
         if tag == 'logicTreeBranchSet':
@@ -720,16 +798,10 @@ fresh nodes, layer sep=2cm, sibling distance=0mm, sibling sep=0.5mm] {
     ]
 
 
-def nrml_to_pdf(file_nrml, include_ids=False, verbose=False):
+def _nrml_to_tex(file_nrml, include_ids=False, verbose=False):
     '''
-    Convert NRML logic tree into a PDF diagram. Output file name is same
-    as input except with .pdf extension. An intermediate .tex file is
-    generated. Lualatex must be installed and present on the system path.
-
-    :param file_nrml: file name of NRML logic tree in XML format
-    :param include_ids: include or omit node ids from diagram
+    Convert NRML logic tree into a TEX file, returning its name.
     '''
-
     if verbose:
         print('Reading %s' % file_nrml)
     root = nrml.read(file_nrml)
@@ -741,14 +813,24 @@ def nrml_to_pdf(file_nrml, include_ids=False, verbose=False):
         with StreamingTexWriter(f, include_ids) as writer:
             writer.serialize(root)
 
-    out_dir = 'build'
+    return file_tex
+
+
+def _tex_to_pdf(file_tex, out_dir='build', verbose=False):
+    '''
+    Run lualatex on a TEX file and move the resulting PDF alongside it.
+    Each run gets its own subdirectory of `out_dir`, so that concurrent runs
+    on files with the same name do not overwrite each other's output. The
+    subdirectory is removed on success, and kept with the log on failure.
+    '''
     file_pdf = file_tex.replace('.tex', '.pdf')
-    build_pdf = os.path.join(out_dir, file_pdf)
+    job_dir = tempfile.mkdtemp(
+        prefix=os.path.basename(file_tex).replace('.tex', '') + '_',
+        dir=out_dir)
+    build_pdf = os.path.join(job_dir, os.path.basename(file_pdf))
     if verbose:
         print('Converting %s to %s' % (file_tex, build_pdf))
-    if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
-    command = ['lualatex', '-output-directory=' + out_dir,
+    command = ['lualatex', '-output-directory=' + job_dir,
                '-interaction=nonstopmode', file_tex]
     print('Executing:' + ' '.join(command))
     subprocess.call(command)
@@ -758,3 +840,68 @@ def nrml_to_pdf(file_nrml, include_ids=False, verbose=False):
     if os.path.exists(file_pdf):
         os.remove(file_pdf)
     os.rename(build_pdf, file_pdf)
+    shutil.rmtree(job_dir)
+
+
+def _nrml_to_pdf(file_nrml, include_ids=False, verbose=False,
+                 out_dir='build'):
+    '''
+    Convert NRML logic tree into a PDF diagram, via a TEX file.
+    '''
+    _tex_to_pdf(_nrml_to_tex(file_nrml, include_ids, verbose),
+                out_dir, verbose)
+
+
+def nrml_to_pdfs(files_nrml, include_ids=False, verbose=False,
+                 max_workers=None):
+    '''
+    Convert several NRML logic trees into PDF diagrams, running up to
+    `max_workers` lualatex processes at once (default: one per CPU). The
+    first file is converted on its own so that the font cache is built
+    before any concurrent runs.
+
+    :param files_nrml: file names of NRML logic trees in XML format
+    :param include_ids: include or omit node ids from diagram
+    :param max_workers: maximum number of concurrent lualatex processes
+    :returns: dict of the exception raised for each file that failed
+    '''
+    out_dir = 'build'
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    errors = {}
+    files_nrml = list(files_nrml)
+    if not files_nrml:
+        return errors
+
+    try:
+        _nrml_to_pdf(files_nrml[0], include_ids, verbose, out_dir)
+    except Exception as ex:  # pylint: disable=broad-except
+        errors[files_nrml[0]] = ex
+
+    with ThreadPoolExecutor(
+            max_workers=max_workers or os.cpu_count() or 1) as executor:
+        futures = [(file_nrml, executor.submit(
+            _nrml_to_pdf, file_nrml, include_ids, verbose, out_dir))
+                   for file_nrml in files_nrml[1:]]
+        for file_nrml, future in futures:
+            ex = future.exception()
+            if ex is not None:
+                errors[file_nrml] = ex
+
+    return errors
+
+
+def nrml_to_pdf(file_nrml, include_ids=False, verbose=False):
+    '''
+    Convert NRML logic tree into a PDF diagram. Output file name is same
+    as input except with .pdf extension. An intermediate .tex file is
+    generated. Lualatex must be installed and present on the system path.
+
+    :param file_nrml: file name of NRML logic tree in XML format
+    :param include_ids: include or omit node ids from diagram
+    '''
+    errors = nrml_to_pdfs([file_nrml], include_ids=include_ids,
+                          verbose=verbose)
+    if errors:
+        raise errors[file_nrml]
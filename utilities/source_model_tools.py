@@ -24,17 +24,27 @@ Most of these functions are utilities specific to Nath & Thingbaijam (2012).
 import os
 import re
 from io import StringIO
-from copy import deepcopy
+from copy import copy
 from numbers import Number
+from functools import lru_cache, partial
 from itertools import product
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
+from matplotlib.path import Path
 from matplotlib.ticker import MultipleLocator
 
 import numpy as np
 import pandas as pd
+from scipy.spatial import cKDTree
+from shapely.geometry import Polygon
 from shapely.wkt import loads, dumps
+from shapely import wkb
+try:
+    from shapely import from_wkt  # vectorized, shapely >= 2.0
+except ImportError:
+    from_wkt = None
 import geopandas as gpd
 from natsort import natsorted, order_by_index, index_natsorted
 
@@ -81,6 +91,10 @@ AREA_REQUIRED = ['geometry']
 GR_REQUIRED = ['mmin', 'mmax', 'a', 'b']
 DISCRETE_REQUIRED = ['mmin', 'occurRates', 'magBin']
 
+# full smoothed-gridded models run to millions of rows, so write in chunks
+CSV_CHUNK_SIZE = 50000
+CSV_BUFFER_SIZE = 1 << 20
+
 
 class MyPolygon(geo.polygon.Polygon):
     # pylint: disable=no-member,no-init,too-few-public-methods
@@ -88,8 +102,17 @@ class MyPolygon(geo.polygon.Polygon):
     Enables fast caclulation of point-to-polygon distances,
     based on openquake.hazardlib.geo.
     '''
+    _edges = None
+
+    @classmethod
+    def from_shapely(cls, polygon):
+        '''
+        Create from the exterior of a shapely polygon in decimal degrees.
+        '''
+        return cls([geo.point.Point(x, y)
+                    for x, y in polygon.exterior.coords[:-1]])
 
-    def distances(self, mesh):
+    def distances(self, mesh, cutoff=None):
         '''
         Compute distances to each point of mesh.
 
@@ -97,14 +120,133 @@ class MyPolygon(geo.polygon.Polygon):
 
         :param mesh:
             :class:`openquake.hazardlib.geo.mesh.Mesh` instance.
+        :param cutoff:
+            Optional scalar or array broadcastable to the mesh. Points whose
+            distance to the polygon bounding box is greater than the cutoff
+            are skipped, and that (smaller) bounding box distance is returned
+            in place of the exact distance.
         :returns:
             Numpy array of `float` values in the same shapes in the input
             coordinate arrays consisting of the distance to each point in
             those arrays. Points inside or on edge of polygon return zero.
         '''
         self._init_polygon2d()
+        if self._edges is None:
+            self._edges = _polygon_edges(self._polygon2d)
         pxx, pyy = self._projection(mesh.lons, mesh.lats)
-        return geo.utils.point_to_polygon_distance(self._polygon2d, pxx, pyy)
+        if cutoff is None:
+            return point_to_polygon_distance(
+                self._polygon2d, pxx, pyy, edges=self._edges)
+
+        min_x, min_y, max_x, max_y = self._polygon2d.bounds
+        result = np.hypot(np.maximum(0, np.maximum(min_x - pxx, pxx - max_x)),
+                          np.maximum(0, np.maximum(min_y - pyy, pyy - max_y)))
+        near = result <= cutoff
+        result[near] = point_to_polygon_distance(
+            self._polygon2d, pxx[near], pyy[near], edges=self._edges)
+        return result
+
+
+def nearest_polygons(polygons, lons, lats):
+    '''
+    Find the nearest of the polygons (a sequence of :class:`MyPolygon`) to
+    each point, returning the indices of the polygons and the distances to
+    them. On equal distance the polygon that comes first wins.
+
+    The polygon owning the vertex nearest to each point only provides an
+    upper bound on the distance, so that exact distances to other polygons
+    are computed only for points within that bound of their bounding boxes.
+    '''
+    lons, lats = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+    mesh = geo.mesh.Mesh(lons, lats)
+
+    vertex_polygons = np.concatenate([
+        np.full(len(polygon.lons), i) for i, polygon in enumerate(polygons)])
+    vertices = np.concatenate([
+        np.column_stack((polygon.lons, polygon.lats))
+        for polygon in polygons])
+    _, nearest_vertex = cKDTree(vertices).query(np.column_stack((lons, lats)))
+    seed = vertex_polygons[nearest_vertex]
+
+    bound = np.empty(lons.shape)
+    for i, polygon in enumerate(polygons):
+        seeded = seed == i
+        if seeded.any():
+            bound[seeded] = polygon.distances(
+                geo.mesh.Mesh(lons[seeded], lats[seeded]))
+
+    nearest = np.full(lons.shape, -1)
+    distance = np.full(lons.shape, np.inf)
+    for i, polygon in enumerate(polygons):
+        polygon_distance = polygon.distances(mesh, cutoff=bound)
+        # reuse the bound where it was computed, so it is not missed by an ulp
+        seeded = seed == i
+        polygon_distance[seeded] = bound[seeded]
+        # skipped points are beyond the bound, so this polygon is not nearest
+        closer = (polygon_distance < distance) & (polygon_distance <= bound)
+        nearest[closer] = i
+        distance[closer] = polygon_distance[closer]
+
+    return nearest, distance
+
+
+def _polygon_edges(polygon):
+    '''
+    Outline path, edge start points, edge vectors and inverse squared edge
+    lengths of a shapely polygon exterior, as used by
+    :func:`point_to_polygon_distance`.
+    '''
+    vertices = np.asarray(polygon.exterior.coords)
+    start_x, start_y = vertices[:-1, 0], vertices[:-1, 1]
+    delta_x, delta_y = np.diff(vertices[:, 0]), np.diff(vertices[:, 1])
+    length_squared = delta_x**2 + delta_y**2
+    inverse_length_squared = np.divide(
+        1., length_squared, out=np.zeros_like(length_squared),
+        where=length_squared > 0)
+
+    return (Path(vertices), start_x, start_y, delta_x, delta_y,
+            inverse_length_squared)
+
+
+def point_to_polygon_distance(polygon, pxx, pyy, block_size=4096,
+                              edges=None):
+    '''
+    Vectorized replacement for
+    :func:`openquake.hazardlib.geo.utils.point_to_polygon_distance`, which
+    calls shapely once per point.
+
+    Distances to every edge of the polygon exterior are computed for blocks
+    of points at a time, and points inside the polygon are set to zero.
+    Output of :func:`_polygon_edges` may be passed as edges to save
+    recomputing it for each call on the same polygon.
+    '''
+    pxx = np.asarray(pxx, dtype=float)
+    pyy = np.asarray(pyy, dtype=float)
+    assert pxx.shape == pyy.shape
+    shape = pxx.shape
+    pxx = pxx.reshape((-1, 1))
+    pyy = pyy.reshape((-1, 1))
+
+    if edges is None:
+        edges = _polygon_edges(polygon)
+    (path, start_x, start_y, delta_x, delta_y,
+     inverse_length_squared) = edges
+
+    result = np.empty(pxx.shape[0])
+    for start in range(0, pxx.shape[0], block_size):
+        block = slice(start, start + block_size)
+        offset_x = pxx[block] - start_x
+        offset_y = pyy[block] - start_y
+        fraction = np.clip((offset_x*delta_x + offset_y*delta_y) *
+                           inverse_length_squared, 0, 1)
+        result[block] = np.sqrt(np.min(
+            (offset_x - fraction*delta_x)**2 +
+            (offset_y - fraction*delta_y)**2, axis=1))
+
+    inside = path.contains_points(np.hstack((pxx, pyy)))
+    result[inside] = 0
+
+    return result.reshape(shape)
 
 
 def read_polygons(file_name, rename=(('polygon coordinates', 'polygon'),)):
@@ -121,48 +263,58 @@ def read_polygons(file_name, rename=(('polygon coordinates', 'polygon'),)):
         line = file.readline()
         columns = [item.strip('[]') for item in line.strip().split(',')]
 
-        rows = []
-        for line in file.readlines():
+        data = {column: [] for column in columns}
+        for line in file:
             fields = line.split(',', len(columns) - 1)
-            series = pd.Series()
             for column, field in zip(columns, fields):
                 if 'id' in column:
                     value = int(field)
                 elif 'polygon' in column:
-                    # TODO: create shapely Polygon directly
-                    value = MyPolygon([
-                        geo.point.Point(float(row.split(',')[0]),
-                                        float(row.split(',')[1]))
-                        for row in field.strip().strip('[]').split(';')
-                        if row.strip()])
+                    coords = np.fromstring(
+                        field.strip().strip('[]').replace(';', ' ')
+                        .replace(',', ' '), sep=' ').reshape(-1, 2)
+                    value = MyPolygon([geo.point.Point(lon, lat)
+                                       for lon, lat in coords.tolist()])
                 else:
                     raise ValueError('Unrecognized column: ' + column)
 
-                series[column] = value
-
-            rows.append(series)
+                data[column].append(value)
 
-    df = pd.DataFrame(rows).rename(columns=dict(rename))
+    df = pd.DataFrame(data, columns=columns).rename(columns=dict(rename))
 
-    df['geometry'] = [loads(polygon.wkt) for polygon in df['polygon']]
+    df['geometry'] = [Polygon(list(zip(polygon.lons, polygon.lats)))
+                      for polygon in df['polygon']]
 
     return df
 
 
-def add_name_id(df):
+def add_name_id(df, inplace=False):
     '''
     Add columns with short names and ids appropriate for NRML source models.
+    The input is copied first unless inplace is set.
     '''
     source_class = get_source_class(df)
-    df = df.copy()
+    if not inplace:
+        df = df.copy()
 
     if source_class is mtkAreaSource:
-        df['source_name'] = df.apply(_areal_source_name, axis=1)
-        df['id'] = df.apply(_areal_source_id, axis=1)
+        df['source_name'] = [_areal_source_name(name) for name in df.index]
+        df['id'] = [_areal_source_id(name) for name in df.index]
 
     elif source_class is mtkPointSource:
-        df['source_name'] = df.apply(_point_source_name, axis=1)
-        df['id'] = df.apply(_point_source_id, axis=1)
+        # grid coordinates repeat, so format each distinct value only once
+        df['source_name'] = (
+            _format_each(df['latitude'], '%gN ') +
+            _format_each(df['longitude'], '%gE ') +
+            _format_each(df['zmin'], '%g-') +
+            _format_each(df['zmax'], '%g km depth ') +
+            _format_each(df['mmin'], 'M%g'))
+        # for the source IDs OpenQuake only accepts a-zA-z0-9_-
+        df['id'] = (
+            _format_each(df['latitude'], '%gN_', ('.', 'p')) +
+            _format_each(df['longitude'], '%gE_', ('.', 'p')) +
+            _format_each(df['layerid'], 'L%d_') +
+            _format_each(df['mmin'], 'M%.1f', ('.', 'p')))
 
     else:
         raise ValueError(
@@ -184,17 +336,21 @@ def natural_sort(df, by='id', index=False):
 
 def make_source(series, source_class, mag_bin_width=0.1):
     '''
-    Make a source from a pandas Series.
+    Make a source from a pandas Series or a dict keyed by column name.
     '''
     if source_class is mtkPointSource:
-        geometry = geo.point.Point(series.longitude, series.latitude)
+        geometry = geo.point.Point(series['longitude'], series['latitude'])
 
     elif source_class is mtkAreaSource:
-        if isinstance(series.geometry, str):
-            series.geometry = loads(series.geometry)
-        coords = list(zip(*series.geometry.exterior.coords.xy))
-        points = [geo.point.Point(lon, lat) for lon, lat in coords]
-        geometry = geo.polygon.Polygon(points + [points[0]])
+        polygon = series['geometry']
+        if isinstance(polygon, geo.polygon.Polygon):
+            geometry = polygon
+        else:
+            if isinstance(polygon, str):
+                polygon = loads(polygon)
+            coords = list(zip(*polygon.exterior.coords.xy))
+            points = [geo.point.Point(lon, lat) for lon, lat in coords]
+            geometry = geo.polygon.Polygon(points + [points[0]])
 
     else:
         raise ValueError('Source class %s not supported' %
@@ -202,29 +358,31 @@ def make_source(series, source_class, mag_bin_width=0.1):
 
     if 'occurRates' in series:
         mag_freq_dist = mfd.EvenlyDiscretizedMFD(
-            series.mmin + series.magBin/2, series.magBin,
-            series.occurRates.tolist())
+            series['mmin'] + series['magBin']/2, series['magBin'],
+            series['occurRates'].tolist())
     else:
         mag_freq_dist = mfd.TruncatedGRMFD(
-            series.mmin, series.mmax, mag_bin_width, series.a, series.b)
+            series['mmin'], series['mmax'], mag_bin_width,
+            series['a'], series['b'])
 
-    nodal_plane_pmf = pmf.PMF(
-        [(1.0, geo.NodalPlane(series.strike, series.dip, series.rake))])
+    nodal_plane_pmf = pmf.PMF([(1.0, geo.NodalPlane(
+        series['strike'], series['dip'], series['rake']))])
 
-    try:
-        hypo_depth_pmf = pmf.PMF([(1.0, series.hypo_depth)])
-    except AttributeError:
-        hypo_depth_pmf = pmf.PMF([(1.0, (series.zmin + series.zmax)/2.0)])
+    if 'hypo_depth' in series:
+        hypo_depth_pmf = pmf.PMF([(1.0, series['hypo_depth'])])
+    else:
+        hypo_depth_pmf = pmf.PMF(
+            [(1.0, (series['zmin'] + series['zmax'])/2.0)])
 
     return source_class(
-        series.id,
-        series.source_name,
+        series['id'],
+        series['source_name'],
         geometry=geometry,
         trt=series['tectonic subregion'],
-        upper_depth=series.zmin,
-        lower_depth=series.zmax,
+        upper_depth=series['zmin'],
+        lower_depth=series['zmax'],
         rupt_aspect_ratio=series['aspect ratio'],
-        mag_scale_rel=series.msr,
+        mag_scale_rel=series['msr'],
         mfd=mag_freq_dist,
         nodal_plane_dist=nodal_plane_pmf,
         hypo_depth_dist=hypo_depth_pmf)
@@ -249,8 +407,9 @@ def source_df_to_list(df):
     '''  # noqa
     source_class = get_source_class(df)
 
-    return df.apply(lambda series: make_source(series, source_class),
-                    axis=1).tolist()
+    columns = df.columns.tolist()
+    return [make_source(dict(zip(columns, values)), source_class)
+            for values in df.itertuples(index=False, name=None)]
 
 
 def get_source_class(df):
@@ -269,25 +428,24 @@ def get_source_class(df):
     return source_class
 
 
-def _areal_source_name(series):
-    return 'zone %s' % series.name
-
+def _areal_source_name(name):
+    return 'zone %s' % name
 
-def _areal_source_id(series):
-    return 'z%s' % series.name
 
+def _areal_source_id(name):
+    return 'z%s' % name
 
-def _point_source_name(series):
-    return '%gN %gE %g-%g km depth M%g' % (series.latitude, series.longitude,
-                                           series.zmin, series.zmax,
-                                           series.mmin)
 
-
-def _point_source_id(series):
-    result = '%gN_%gE_L%d_M%.1f' % (series.latitude, series.longitude,
-                                    series.layerid, series.mmin)
-    # For the source IDs OpenQuake only accepts a-zA-z0-9_-
-    return result.replace('.', 'p')
+def _format_each(values, fmt, replace=None):
+    '''
+    Format each of the values as a string, returning an object array that
+    can be concatenated with +. Each distinct value is formatted only once.
+    '''
+    unique, inverse = np.unique(values, return_inverse=True)
+    strings = [fmt % value for value in unique]
+    if replace is not None:
+        strings = [string.replace(*replace) for string in strings]
+    return np.array(strings, dtype=object)[inverse]
 
 
 def _check_columns(df):
@@ -316,19 +474,35 @@ def df2nrml(df, model_name):
     magnitude to support alternative tectonic region types for large-magnitude
     events.
     '''
-    if model_name.endswith('.xml'):
-        model_name = model_name[:-4]
-    nrml_file = model_name.replace(' ', '_') + '.xml'
+    return _sources2nrml(_prepare_sources(df), model_name)
 
+
+def _prepare_sources(df):
+    '''
+    Drop aseismic zones, add names and ids and twin sources by magnitude,
+    ready for :func:`_sources2nrml`.
+    '''
     aseismic = df.a == 0
     if any(aseismic):
         print('Dropping zones with no seismicity from NRML: ' +
               ', '.join(str(item) for item in df.loc[aseismic].index))
         df = df.loc[~aseismic].copy()
 
-    df = add_name_id(df)
+    df = add_name_id(df, inplace=any(aseismic))
     df = twin_source_by_magnitude(df)
     _check_columns(df)
+
+    return df
+
+
+def _sources2nrml(df, model_name):
+    '''
+    Write sources prepared by :func:`_prepare_sources` to NRML.
+    '''
+    if model_name.endswith('.xml'):
+        model_name = model_name[:-4]
+    nrml_file = model_name.replace(' ', '_') + '.xml'
+
     df = natural_sort(df, by='id')  # this may do nothing ...
 
     source_list = source_df_to_list(df)
@@ -350,6 +524,15 @@ def df2nrml(df, model_name):
     return source_model
 
 
+def _write_csv(df, csv_file, **kwargs):
+    '''
+    Write with a large file buffer, formatting rows in chunks.
+    '''
+    with open(csv_file, 'w', newline='', buffering=CSV_BUFFER_SIZE) as file:
+        df.to_csv(file, float_format='%.5g', chunksize=CSV_CHUNK_SIZE,
+                  **kwargs)
+
+
 def points2nrml(df, base_name, by=('mmin model',), fmt='mmin%g'):
     '''
     Write multiple pandas DataFrame of point source models to NRML.
@@ -358,11 +541,12 @@ def points2nrml(df, base_name, by=('mmin model',), fmt='mmin%g'):
         by = [by]
     else:
         by = list(by)
-    df.sort_values(['mmin model', 'layerid'] + COORDINATES, inplace=True)
 
+    # prepare all sources at once, then sort each model naturally by id
+    df = _prepare_sources(df)
     for index, group_df in df.groupby(by):
         model_name = base_name + ' ' + fmt % index
-        df2nrml(group_df, model_name)
+        _sources2nrml(group_df, model_name)
 
 
 def points2csv(df, base_name, by=('mmin model', 'layerid'),
@@ -378,21 +562,18 @@ def points2csv(df, base_name, by=('mmin model', 'layerid'),
         base_name = base_name[:-4]
 
     # TODO: select columns of interest, or at least control column order?
-    df.drop('geometry', axis=1, inplace=True)
+    df.drop('geometry', axis=1, inplace=True, errors='ignore')
 
     df = add_name_id(df)
     df = add_binwise_rates(df)
     _check_columns(df)
-    df = natural_sort(df, by='id')
-
-    df.sort_values(by + COORDINATES, inplace=True)
 
     for index, group_df in df.groupby(by):
         model_name = base_name + ' ' + fmt % index
         csv_file = model_name.replace(' ', '_') + '.csv'
         print('Writing: ' + os.path.abspath(csv_file))
-        group_df.drop(columns=by).to_csv(csv_file, index=False,
-                                         float_format='%.5g')
+        _write_csv(group_df.drop(columns=by).sort_values(COORDINATES),
+                   csv_file, index=False)
 
 
 def csv2points(base_name, by=('mmin model', 'layerid'),
@@ -419,7 +600,7 @@ def csv2points(base_name, by=('mmin model', 'layerid'),
     _check_columns(df)
 
     if 'geometry' in df:
-        df['geometry'] = df.geometry.apply(loads)
+        df['geometry'] = _wkt_to_geometries(df['geometry'].values)
 
     df.sort_values(by + COORDINATES, inplace=True)
     df.reset_index(drop=True, inplace=True)
@@ -427,10 +608,41 @@ def csv2points(base_name, by=('mmin model', 'layerid'),
     return df
 
 
-def areal2csv(df, model_name):
+def _wkt_to_geometries(strings):
+    '''
+    Parse a sequence of WKT strings, in a single call where shapely >= 2.0
+    is available.
+    '''
+    if from_wkt is not None:
+        return from_wkt(np.asarray(strings, dtype=object))
+    return [loads(string) for string in strings]
+
+
+def _geometry_codec(geometry_format):
+    '''
+    Return functions converting a geometry to a CSV string, and a sequence of
+    CSV strings back to geometries, either WKT rounded to 0.01° (readable by
+    QGIS) or full precision hex WKB (much faster to parse).
+    '''
+    if geometry_format == 'wkt':
+        return (lambda geometry: dumps(geometry, rounding_precision=2),
+                _wkt_to_geometries)
+    elif geometry_format == 'wkb':
+        return (lambda geometry: wkb.dumps(geometry, hex=True),
+                lambda strings: [wkb.loads(string, hex=True)
+                                 for string in strings])
+
+    raise ValueError('Unrecognized geometry format: ' + geometry_format)
+
+
+def areal2csv(df, model_name, geometry_format='wkt'):
     '''
     Write areal model with names, ids and geometry.
+
+    Geometry is written as WKT by default, or as hex WKB if geometry_format
+    is 'wkb', in which case read it back with the same geometry_format.
     '''
+    dump, _ = _geometry_codec(geometry_format)
     if model_name.endswith('.csv'):
         model_name = model_name[:-4]
     csv_file = model_name.replace(' ', '_') + '.csv'
@@ -441,25 +653,25 @@ def areal2csv(df, model_name):
         csv_file += '.csv'
     print('Writing: ' + os.path.abspath(csv_file))
 
-    df['centroid'] = df.geometry.apply(  # facilitates plotting symbols in QGIS
-        lambda polygon: dumps(polygon.centroid, rounding_precision=2))
-    df['geometry'] = df.geometry.apply(
-        lambda polygon: dumps(polygon, rounding_precision=2))
-    df = add_name_id(df)
+    # centroid facilitates plotting symbols in QGIS
+    df['centroid'] = [dump(polygon.centroid) for polygon in df.geometry]
+    df['geometry'] = [dump(polygon) for polygon in df.geometry]
+    df = add_name_id(df, inplace=True)
     _check_columns(df)
 
-    df.to_csv(csv_file, float_format='%.5g')
+    _write_csv(df, csv_file)
 
 
-def csv2areal(csv_file):
+def csv2areal(csv_file, geometry_format='wkt'):
     '''
     read areal model, returning a geopandas DataFrame.
     '''
+    _, load = _geometry_codec(geometry_format)
     if not csv_file.endswith('.csv'):
         csv_file += '.csv'
     print('Reading: ' + os.path.abspath(csv_file))
     df = pd.read_csv(csv_file, index_col='zoneid')
-    df['geometry'] = df['geometry'].apply(loads)
+    df['geometry'] = load(df['geometry'].values)
     df = gpd.GeoDataFrame(df, crs='WGS84')
     _check_columns(df)
 
@@ -488,20 +700,47 @@ def focal_mech(dip, rake, threshold=30):
     45°: Zhao et al. (2006)
     '''
     if isinstance(dip, Number) and isinstance(rake, Number):
-        rake = wrap(rake)
-        if 0 <= wrap(dip) <= 90:
-            if threshold < rake < 180 - threshold:
-                return 'reverse'  # dip-slip
-            elif threshold < -rake < 180 - threshold:
-                return 'normal'  # dip-slip
-            elif np.abs(rake) < threshold:
-                return 'sinistral'  # strike-slip
+        return _focal_mech(dip, rake, threshold)
+
+    return _focal_mechs(dip, rake, threshold).tolist()
+
+
+@lru_cache(maxsize=None)
+def _focal_mech(dip, rake, threshold):
+    '''
+    Scalar implementation of focal_mech(), memoized since zone tables repeat
+    the same few (dip, rake) pairs.
+    '''
+    rake = wrap(rake)
+    if 0 <= wrap(dip) <= 90:
+        if threshold < rake < 180 - threshold:
+            return 'reverse'  # dip-slip
+        elif threshold < -rake < 180 - threshold:
+            return 'normal'  # dip-slip
+        elif np.abs(rake) < threshold:
+            return 'sinistral'  # strike-slip
 
-            return 'dextral'  # strike-slip
+        return 'dextral'  # strike-slip
 
-        return 'undefined'
+    return 'undefined'
 
-    return [focal_mech(d, r) for d, r in zip(dip, rake)]
+
+def _focal_mechs(dip, rake, threshold):
+    '''
+    Array implementation of focal_mech(), returning an array of strings.
+    '''
+    rake = wrap(np.asarray(rake, dtype=float))
+    dip = wrap(np.asarray(dip, dtype=float))
+    with np.errstate(invalid='ignore'):
+        valid = (0 <= dip) & (dip <= 90)
+        conditions = [
+            valid & (threshold < rake) & (rake < 180 - threshold),
+            valid & (threshold < -rake) & (-rake < 180 - threshold),
+            valid & (np.abs(rake) < threshold),
+            valid]
+    return np.select(conditions,
+                     ['reverse', 'normal', 'sinistral', 'dextral'],
+                     default='undefined')
 
 
 FAULTING_STYLES = pd.read_fwf(StringIO('''\
@@ -531,24 +770,79 @@ def faulting_style(strike, dip, rake):
     strike, dip, rake: tuple of float
         angles defining most physically plausible fault plane
     '''
-    try:
-        rake = wrap(rake)
+    if all(isinstance(angle, Number) for angle in (strike, dip, rake)):
+        return _faulting_style(strike, dip, rake)
+
+    rake = wrap(np.asarray(rake, dtype=float))
+    styles = _focal_mechs(dip, rake, 30)
+    _, dip2, rake2 = aux_planes(strike, dip, rake)
+    styles2 = _focal_mechs(dip2, rake2, 30)
+
+    dip_slip = ['normal', 'reverse']
+    return np.where(
+        styles == 'undefined', 'undefined',
+        np.where(np.isin(styles, dip_slip), styles,
+                 np.where(np.isin(styles2, dip_slip), styles2,
+                          'strike-slip'))).tolist()
+
+
+@lru_cache(maxsize=None)
+def _faulting_style(strike, dip, rake):
+    '''
+    Scalar implementation of faulting_style(), memoized like _focal_mech().
+    '''
+    rake = wrap(rake)
+
+    if 0 <= wrap(dip) <= 90:
+        candidates = [
+            focal_mech(dip, rake),
+            focal_mech(*(aux_plane(strike, dip, rake)[1:]))
+            ]
+
+        return next(
+            (faulting_style for faulting_style in candidates
+             if faulting_style in ['normal', 'reverse']),
+            'strike-slip')
+
+    return 'undefined'
+
+
+def aux_planes(strike, dip, rake):
+    '''
+    Array version of :func:`obspy.imaging.beachball.aux_plane`, returning
+    strike, dip and rake arrays defining the auxiliary nodal planes.
+    '''
+    r2d = 180/np.pi
+
+    z = (np.asarray(strike, dtype=float) + 90)/r2d
+    z2 = np.asarray(dip, dtype=float)/r2d
+    z3 = np.asarray(rake, dtype=float)/r2d
+
+    # slip vector in plane 1
+    sl1 = -np.cos(z3)*np.cos(z) - np.sin(z3)*np.sin(z)*np.cos(z2)
+    sl2 = np.cos(z3)*np.sin(z) - np.sin(z3)*np.cos(z)*np.cos(z2)
+    sl3 = np.sin(z3)*np.sin(z2)
 
-        if 0 <= wrap(dip) <= 90:
-            candidates = [
-                focal_mech(dip, rake),
-                focal_mech(*(aux_plane(strike, dip, rake)[1:]))
-                ]
+    # strike and dip of plane 2, which has the slip vector as its normal
+    sign = np.where(sl3 < 0, -1, 1)
+    north, east, up = sign*sl2, sign*sl1, sign*sl3
+    strike2 = np.mod(np.arctan2(east, north)*r2d - 90, 360)
+    dip2 = np.arctan2(np.sqrt(north**2 + east**2), up)*r2d
 
-            return next(
-                (faulting_style for faulting_style in candidates
-                 if faulting_style in ['normal', 'reverse']),
-                'strike-slip')
+    # normal vector to plane 1 and strike vector of plane 2
+    n1 = np.sin(z)*np.sin(z2)
+    n2 = np.cos(z)*np.sin(z2)
+    h1 = -sl2
+    h2 = sl1
 
-        return 'undefined'
+    cos_rake2 = (h1*n1 + h2*n2)/np.sqrt(h1*h1 + h2*h2)
+    # may exceed 1 only due to floating point precision
+    cos_rake2 = np.clip(cos_rake2, -1, 1)
+    rake2 = np.arccos(cos_rake2)*r2d
+    # like obspy, undefined angles give a rake of zero
+    rake2 = np.where(sl3 > 0, rake2, np.where(sl3 <= 0, -rake2, 0))
 
-    except ValueError:
-        return [faulting_style(s, d, r) for s, d, r in zip(strike, dip, rake)]
+    return strike2, dip2, rake2
 
 
 def twin_source_by_magnitude(df, column='tectonic subregion',
@@ -591,12 +885,12 @@ def twin_source_by_magnitude(df, column='tectonic subregion',
     # prune bins above/below maximum magnitude
     if 'occurRates' in df.columns:
         above_rates, below_rates = [], []
-        for _, zone in df.loc[indices].iterrows():
-
-            num_bins = zone['occurRates'].size
-            mags = zone['mmin'] + zone['magBin']*(np.arange(num_bins) + 0.5)
-            above_rates += [zone['occurRates'][mags > mag_thresh]]
-            below_rates += [zone['occurRates'][mags < mag_thresh]]
+        for mmin, mag_bin, rates in zip(df.loc[indices, 'mmin'],
+                                        df.loc[indices, 'magBin'],
+                                        df.loc[indices, 'occurRates']):
+            mags = mmin + mag_bin*(np.arange(rates.size) + 0.5)
+            above_rates.append(rates[mags > mag_thresh])
+            below_rates.append(rates[mags < mag_thresh])
 
         twinned_df['occurRates'] = above_rates
         for zone, rates in zip(df.index[indices], below_rates):
@@ -611,13 +905,20 @@ def add_binwise_rates(df, mag_start=5, mag_stop=8, mag_step=1):
     '''
     Add binwise sesismicity rates for comparison
     '''
-    for mag in range(mag_start, mag_stop, mag_step):
-        log_n_m_lo = df['a'] - df['b']*np.maximum(df['mmin'], mag)
-        log_n_m_hi = df['b'] - df['b']*np.minimum(df['mmax'], mag + 1)
+    mags = np.arange(mag_start, mag_stop, mag_step).reshape(1, -1)
+    a_values = df['a'].values.reshape(-1, 1)
+    b_values = df['b'].values.reshape(-1, 1)
+
+    log_n_m_lo = a_values - b_values*np.maximum(
+        df['mmin'].values.reshape(-1, 1), mags)
+    log_n_m_hi = a_values - b_values*np.minimum(
+        df['mmax'].values.reshape(-1, 1), mags + mag_step)
 
-        with np.errstate(invalid='ignore', divide='ignore'):
-            df['logN_%.1f-%.1f' % (mag, mag + 1)] = \
-                np.log10(10**log_n_m_lo - 10**log_n_m_hi).round(2)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        rates = np.log10(10**log_n_m_lo - 10**log_n_m_hi).round(2)
+
+    for mag, rate in zip(mags.ravel(), rates.T):
+        df['logN_%.1f-%.1f' % (mag, mag + mag_step)] = rate
 
     return df
 
@@ -626,13 +927,51 @@ def extract_param(df, param, x='longitude', y='latitude'):
     '''
     Extract a matrix of parameter grid values from a dataframe, for plotting.
     '''
+    x_values, y_values = df[x].values, df[y].values
+    values = df[param].values
+    ordinate, abscissa = np.unique(x_values), np.unique(y_values)
+
+    # points on a complete regular grid need only be sorted, not pivoted
+    if ordinate.size*abscissa.size == values.size and \
+            not pd.isnull(values).any():
+        order = np.lexsort((x_values, y_values))
+        if (x_values[order] == np.tile(ordinate, abscissa.size)).all() and \
+                (y_values[order] == np.repeat(abscissa, ordinate.size)).all():
+            data = values[order].reshape(abscissa.size, ordinate.size)
+            return data, ordinate, abscissa
+
     pivot_df = df.pivot_table(index=y, columns=x, values=param)
     ordinate = pivot_df.columns.values
     abscissa = pivot_df.index.values
-    data = pivot_df.as_matrix()
+    data = pivot_df.values
     return data, ordinate, abscissa
 
 
+def _subcatalogue(catalogue, selected):
+    '''
+    Return a catalogue of the selected events. Only the selected data is
+    copied, the original catalogue is left untouched.
+    '''
+    subcatalogue = copy(catalogue)
+    subcatalogue.data = dict(catalogue.data)
+    subcatalogue.select_catalogue_events(selected)
+    return subcatalogue
+
+
+def _catalogue_slices(catalogue, slice_key, slice_ids):
+    '''
+    Sub-catalogues with each of `slice_ids` for `slice_key`. Events are
+    grouped with a single stable sort rather than one scan per slice.
+    '''
+    keys = np.asarray(catalogue.data[slice_key])
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    starts = np.searchsorted(sorted_keys, slice_ids, side='left')
+    stops = np.searchsorted(sorted_keys, slice_ids, side='right')
+    return [_subcatalogue(catalogue, order[start:stop])
+            for start, stop in zip(starts, stops)]
+
+
 def plot_mag_time_density_slices(
         catalogue, completeness_tables, slice_key, slice_ids,
         mag_bin=0.1, time_bin=1):
@@ -644,15 +983,12 @@ def plot_mag_time_density_slices(
     fig, axes = plt.subplots(len(slice_ids), 1,
                              figsize=(8, 2*len(slice_ids)), sharex=True)
     fig.subplots_adjust(hspace=0)
-    for ax, slice_id, completeness_tables_slice \
-            in zip(axes, slice_ids, completeness_tables):
+    catalogue_slices = _catalogue_slices(catalogue, slice_key, slice_ids)
+    for ax, slice_id, catalogue_slice, completeness_tables_slice \
+            in zip(axes, slice_ids, catalogue_slices, completeness_tables):
 
         annotate('%s %d' % (slice_key, slice_id), loc='upper left', ax=ax)
 
-        catalogue_slice = deepcopy(catalogue)
-        in_slice = catalogue_slice.data[slice_key] == slice_id
-        catalogue_slice.select_catalogue_events(in_slice)
-
         plot_magnitude_time_density(
             catalogue_slice, mag_bin, time_bin,
             completeness=completeness_tables_slice, ax=ax)
@@ -660,13 +996,27 @@ def plot_mag_time_density_slices(
     return fig
 
 
+def _stepp_completeness(catalogue, comp_config, deduplicate, mag_range,
+                        year_range):
+    '''
+    Stepp (1971) analysis of a single catalogue, returning the model.
+    '''
+    model = Stepp1971()
+    model.completeness(catalogue, comp_config)
+    model.simplify(deduplicate, mag_range, year_range)
+    return model
+
+
 def plot_completeness_slices(catalogue, slice_key, slice_ids,
                              mag_bin=0.5, time_bin=1.,
                              deduplicate=True, mag_range=(4., None),
-                             year_range=None):
+                             year_range=None, max_workers=1):
     """
     Stepp (1971) analysis on sub-catalogues, where `slice_key` and
     `slice_ids` determine how the sub-catalouges are formed.
+
+    Slices are analysed in series unless `max_workers` > 1 (or None for one
+    process per slice), since a single Stepp analysis takes milliseconds.
     """
     comp_config = {'magnitude_bin': mag_bin,
                    'time_bin': time_bin,
@@ -676,16 +1026,22 @@ def plot_completeness_slices(catalogue, slice_key, slice_ids,
                              figsize=(6, 2*len(slice_ids)), sharex=True)
     fig.subplots_adjust(hspace=0)
 
-    slice_completeness_tables = []
-    for ax, slice_id in zip(axes, slice_ids):
-
-        catalogue_slice = deepcopy(catalogue)
-        in_slice = catalogue_slice.data[slice_key] == slice_id
-        catalogue_slice.select_catalogue_events(in_slice)
+    catalogue_slices = _catalogue_slices(catalogue, slice_key, slice_ids)
+    analyse = partial(_stepp_completeness, comp_config=comp_config,
+                      deduplicate=deduplicate, mag_range=mag_range,
+                      year_range=year_range)
+    max_workers = min(max_workers or len(catalogue_slices),
+                      len(catalogue_slices))
+    if max_workers > 1:
+        # analyse slices in parallel, but plot them here in the main process
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            models = list(executor.map(analyse, catalogue_slices))
+    else:
+        models = [analyse(catalogue_slice)
+                  for catalogue_slice in catalogue_slices]
 
-        model = Stepp1971()
-        model.completeness(catalogue_slice, comp_config)
-        model.simplify(deduplicate, mag_range, year_range)
+    slice_completeness_tables = []
+    for ax, slice_id, model in zip(axes, slice_ids, models):
         slice_completeness_tables.append(model.completeness_table.tolist())
 
         annotate('%s %d' % (slice_key, slice_id), loc='upper left', ax=ax)
@@ -708,14 +1064,12 @@ def plot_depth_distance(catalogue, coordinate_limits, ordinate, name=None,
 
     assert ordinate in ['latitude', 'longitude']
 
-    subcatalogue = deepcopy(catalogue)
-
     lat_min, lat_max, lon_min, lon_max = coordinate_limits
-    subcatalogue.purge_catalogue(
-        (subcatalogue.data['latitude'] >= coordinate_limits[0]) &
-        (subcatalogue.data['latitude'] <= coordinate_limits[1]) &
-        (subcatalogue.data['longitude'] >= coordinate_limits[2]) &
-        (subcatalogue.data['longitude'] <= coordinate_limits[3]))
+    subcatalogue = _subcatalogue(catalogue, np.where(
+        (catalogue.data['latitude'] >= coordinate_limits[0]) &
+        (catalogue.data['latitude'] <= coordinate_limits[1]) &
+        (catalogue.data['longitude'] >= coordinate_limits[2]) &
+        (catalogue.data['longitude'] <= coordinate_limits[3]))[0])
 
     if colour == 'magnitude':
         colour = subcatalogue.data['magnitude']
@@ -832,11 +1186,3 @@ def plot_smoothed(file_template, layer_ids, min_mags, grid_step,
         ax.set_ylim(coordinate_limits[2:])
 
     return image
-
-
-def try_again(success=False):
-    '''
-    If at first you don't succeed, try, try again.
-    '''
-    while not success:
-        try_again()
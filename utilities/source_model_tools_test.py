@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# Indian Subcontinent PSHA
+# Copyright (C) 2016-2018 Nick Ackerley
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+Regression tests of vectorized source model tools against the scalar
+implementations they replace.
+'''
+import numpy as np
+from shapely.geometry import Point, Polygon
+from obspy.imaging.beachball import aux_plane
+
+import source_model_tools as smt
+
+rng = np.random.RandomState(1971)
+
+# random planes, plus canonical faulting styles and some degenerate planes
+strikes = np.concatenate((rng.uniform(0, 360, 3000), [0, 0, 0, 0, 30, 0]))
+dips = np.concatenate((rng.uniform(0, 90, 3000), [90, 90, 45, 45, 0, 90]))
+rakes = np.concatenate((rng.uniform(-180, 180, 3000),
+                        [0, 180, 90, -90, 45, -180]))
+
+# aux_planes vs. obspy
+result = np.column_stack(smt.aux_planes(strikes, dips, rakes))
+expected = np.array([aux_plane(*plane)
+                     for plane in zip(strikes, dips, rakes)])
+difference = result - expected
+difference[:, [0, 2]] = (difference[:, [0, 2]] + 180) % 360 - 180
+assert np.allclose(difference, 0, atol=1e-8)
+
+# _focal_mechs vs. _focal_mech, including dips outside [0, 90]
+test_dips = rng.uniform(-120, 240, 3000)
+test_rakes = np.concatenate((rng.uniform(-360, 360, 2990),
+                             [30, 150, -30, -150, 0, 180, -180, 90, -90, 45]))
+for threshold in [30, 45]:
+    result = smt._focal_mechs(test_dips, test_rakes, threshold).tolist()
+    expected = [smt._focal_mech(dip, rake, threshold)
+                for dip, rake in zip(test_dips, test_rakes)]
+    assert result == expected
+
+# array vs. scalar faulting_style
+result = smt.faulting_style(strikes, dips, rakes)
+expected = [smt.faulting_style(*plane)
+            for plane in zip(strikes.tolist(), dips.tolist(), rakes.tolist())]
+assert result == expected
+
+# point_to_polygon_distance vs. shapely, for a non-convex polygon and random
+# points outside and inside it, on its vertices and on its edges
+polygon = Polygon([(0, 0), (10, 0), (10, 10), (5, 3), (0, 10)])
+vertices = np.asarray(polygon.exterior.coords)
+points = np.concatenate((
+    rng.uniform(-5, 15, (2000, 2)),
+    vertices,
+    (vertices[:-1] + vertices[1:])/2,
+    [[5, 1], [1, 1], [9, 8]]))
+result = smt.point_to_polygon_distance(polygon, points[:, 0], points[:, 1])
+expected = np.array([polygon.distance(Point(x, y)) for x, y in points])
+assert np.allclose(result, expected, rtol=0, atol=1e-12)
+assert (result[-3:] == 0).all()
+
+# nearest_polygons vs. dense argmin, where ties go to the first polygon
+square = smt.MyPolygon.from_shapely(Polygon([
+    (80, 20), (81, 20), (81, 20.6), (81, 21), (80, 21)]))
+# shares the vertex at (81, 20.6) and part of the east edge of the square,
+# and overlaps it further south, where its notch vertex at (80.9, 20.6) is
+# nearer than any vertex of the square, so a vertex-seeded search would
+# favour it although both distances are zero
+neighbour = smt.MyPolygon.from_shapely(Polygon([
+    (80.5, 20), (82, 20), (82, 21), (81, 21), (81, 20.6), (80.9, 20.6)]))
+far = smt.MyPolygon.from_shapely(Polygon([(84, 18), (86, 18), (85, 19)]))
+polygons = [square, neighbour, far]
+lons = np.concatenate((rng.uniform(78, 88, 2000), [81, 80.9]))
+lats = np.concatenate((rng.uniform(16, 24, 2000), [20.6, 20.5]))
+nearest, distance = smt.nearest_polygons(polygons, lons, lats)
+mesh = smt.geo.mesh.Mesh(lons, lats)
+distances = np.array([polygon.distances(mesh) for polygon in polygons])
+assert (nearest == np.argmin(distances, axis=0)).all()
+assert (distance == distances.min(axis=0)).all()
+assert (distances[:2, -2:] == 0).all()
+assert (nearest[-2:] == 0).all()
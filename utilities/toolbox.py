@@ -263,9 +263,8 @@ def df_compare(df_new, df_ref):
     Compares two pandas.DataFrame objects by computing their difference.
     '''
 
-    numeric = np.array([[is_numeric(item)
-                         for item in row[1]]
-                        for row in df_ref.iterrows()])
+    numeric = np.array([[is_numeric(item) for item in row]
+                        for row in df_ref.itertuples(index=False, name=None)])
     non_zero = (df_ref != 0) & numeric
     df_dif = df_ref.copy()
     df_dif = df_dif.where(~numeric,